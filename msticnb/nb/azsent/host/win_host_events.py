@@ -4,17 +4,26 @@
 # license information.
 # --------------------------------------------------------------------------
 """Notebooklet for Windows Security Events."""
+
+import hashlib
+import multiprocessing
 import os
 import pkgutil
-from typing import Any, Dict, Iterable, Optional, Union
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from functools import lru_cache, partial
+from itertools import chain
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
 from bokeh.models import LayoutDOM
 from bokeh.plotting.figure import Figure
-from defusedxml import ElementTree
-from defusedxml.ElementTree import ParseError
 from IPython.display import display
+from lxml import etree  # nosec
 from msticpy.common.timespan import TimeSpan
 
 try:
@@ -33,6 +42,7 @@ from ....common import (
     set_text,
 )
 from ....notebooklet import NBMetadata, Notebooklet, NotebookletResult
+from ....options import get_opt
 
 __version__ = VERSION
 __author__ = "Ian Hellen"
@@ -51,10 +61,22 @@ class WinHostEventsResult(NotebookletResult):
     Attributes
     ----------
     all_events : pd.DataFrame
-        DataFrame of all raw events retrieved.
+        DataFrame of all raw events retrieved. The query
+        returns the TimeGenerated, Account, Activity, EventID,
+        EventData and Computer columns plus the account
+        management columns (e.g. TargetUserName, SubjectUserName,
+        MemberName, TargetAccount). Other SecurityEvent columns
+        are not returned unless requested with the `add_columns`
+        or `all_columns` parameters.
+        To reduce memory use, integer columns are downcast to
+        the smallest type (e.g. EventID is unsigned) and string
+        columns with many repeated values are categoricals.
+        Convert columns with `astype` before assigning new values
+        or doing arithmetic (unsigned columns wrap around below 0).
     event_pivot : pd.DataFrame
         DataFrame that is a pivot table of event ID
-        vs. Account
+        vs. Account. Only created if the `event_pivot`
+        option is selected.
     account_events : pd.DataFrame
         DataFrame containing a subset of account management
         events such as account and group modification.
@@ -155,6 +177,17 @@ class WinHostEvents(Notebooklet):
             Alternative to specifying timespan parameter.
         end : Union[datetime, datelike-string]
             Alternative to specifying timespan parameter.
+        add_columns : Iterable[str], optional
+            Additional SecurityEvent columns to return
+            in `all_events`.
+        all_columns : bool, optional
+            If True, return all SecurityEvent columns
+            in `all_events`, by default False.
+        cache : bool, optional
+            Override the `cache` option for this run. If True,
+            query results are saved to and re-used from the
+            `~/.msticnb_cache` folder. Cached files expire
+            after 24 hours.
 
         Returns
         -------
@@ -180,19 +213,34 @@ class WinHostEvents(Notebooklet):
             notebooklet=self, description=self.metadata.description, timespan=timespan
         )
 
-        all_events_df, event_pivot_df = _get_win_security_events(
-            self.query_provider, host_name=value, timespan=self.timespan
+        all_events_df = _get_win_security_events(
+            self.query_provider,
+            host_name=value,
+            timespan=self.timespan,
+            add_columns=kwargs.get("add_columns"),
+            all_columns=kwargs.get("all_columns", False),
+            use_cache=kwargs.get("cache", get_opt("cache")),
         )
         result.all_events = all_events_df
-        result.event_pivot = event_pivot_df
 
+        accounts = None
         if "event_pivot" in self.options:
-            _display_event_pivot(event_pivot=event_pivot_df)
+            accounts = _normalize_accounts(all_events_df["Account"])
+            result.event_pivot = _create_event_pivot(
+                all_events_df["Activity"], accounts
+            )
+            _display_event_pivot(event_pivot=result.event_pivot)
 
         if "acct_events" in self.options:
-            result.account_events = _extract_acct_mgmt_events(event_data=all_events_df)
+            acct_mask = _get_acct_mgmt_mask(event_data=all_events_df)
+            result.account_events = all_events_df.iloc[acct_mask]
+            # re-use the normalized accounts if already created
+            if accounts is None:
+                acct_accounts = _normalize_accounts(result.account_events["Account"])
+            else:
+                acct_accounts = accounts[acct_mask]
             result.account_pivot = _create_acct_event_pivot(
-                account_event_data=result.account_events
+                account_event_data=result.account_events, accounts=acct_accounts
             )
             if result.account_pivot is not None:
                 _display_acct_event_pivot(event_pivot_df=result.account_pivot)
@@ -248,121 +296,392 @@ class WinHostEvents(Notebooklet):
 
 # %%
 # Get Windows Security Events
-def _get_win_security_events(qry_prov, host_name, timespan):
+# Columns returned by the events query
+_EVENT_COLUMNS = [
+    "TimeGenerated",
+    "Account",
+    "Activity",
+    "EventID",
+    "EventData",
+    "Computer",
+]
+
+# Account management columns used by acct_events and other consumers
+_ACCT_MGMT_COLUMNS = [
+    "SubjectUserName",
+    "SubjectDomainName",
+    "SubjectUserSid",
+    "SubjectLogonId",
+    "SubjectAccount",
+    "TargetUserName",
+    "TargetDomainName",
+    "TargetUserSid",
+    "TargetAccount",
+    "MemberName",
+    "MemberSid",
+    "SamAccountName",
+]
+
+
+# Folder used to cache query results between runs
+_CACHE_DIR = Path("~/.msticnb_cache").expanduser()
+# Cached results older than this are deleted
+_CACHE_MAX_AGE = timedelta(hours=24)
+
+
+def _get_win_security_events(
+    qry_prov,
+    host_name,
+    timespan,
+    add_columns: Optional[Iterable[str]] = None,
+    all_columns: bool = False,
+    use_cache: bool = False,
+):
     nb_data_wait("SecurityEvent")
 
-    all_events_df = qry_prov.WindowsSecurity.list_host_events(
-        timespan,
-        host_name=host_name,
-        add_query_items="| where EventID != 4688 and EventID != 4624",
+    query_items = "| where EventID != 4688 and EventID != 4624"
+    if not all_columns:
+        # dict.fromkeys removes duplicates, preserving order
+        columns = dict.fromkeys(
+            chain(_EVENT_COLUMNS, _ACCT_MGMT_COLUMNS, add_columns or [])
+        )
+        query_items += f" | project {', '.join(columns)}"
+    all_events_df = _cached_query(
+        cache_key=(
+            "WindowsSecurity.list_host_events",
+            # results from different workspaces/tenants must not be shared
+            getattr(qry_prov, "environment", None),
+            getattr(qry_prov, "connection_string", None),
+            host_name,
+            timespan.start,
+            timespan.end,
+            query_items,
+        ),
+        query_func=partial(
+            qry_prov.WindowsSecurity.list_host_events,
+            timespan,
+            host_name=host_name,
+            add_query_items=query_items,
+        ),
+        use_cache=use_cache,
+    )
+    return _optimize_dtypes(all_events_df)
+
+
+def _cached_query(
+    cache_key: Tuple[Any, ...],
+    query_func: Callable[[], pd.DataFrame],
+    use_cache: bool = False,
+) -> pd.DataFrame:
+    # Return the results for `cache_key` from the cache folder if
+    # present, otherwise run `query_func` and save the results.
+    # Caching needs pyarrow to read/write parquet and is skipped
+    # if this is not available or `use_cache` is False.
+    if not use_cache:
+        return query_func()
+    key_hash = hashlib.sha256(repr(cache_key).encode("utf-8")).hexdigest()
+    cache_file = _CACHE_DIR.joinpath(f"{key_hash}.parquet")
+    if cache_file.is_file() and not _cache_file_expired(cache_file):
+        try:
+            return pd.read_parquet(cache_file)
+        except (ImportError, OSError, ValueError):
+            pass
+    result_df = query_func()
+    if (
+        isinstance(result_df, pd.DataFrame)
+        and not result_df.empty
+        and _can_cache(result_df)
+    ):
+        try:
+            _CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            _remove_expired_cache_files()
+            result_df.to_parquet(cache_file)
+        except (ImportError, OSError, TypeError, ValueError):
+            # results cannot be cached - return them uncached
+            pass
+    return result_df
+
+
+def _cache_file_expired(cache_file: Path) -> bool:
+    file_age = time.time() - cache_file.stat().st_mtime
+    return file_age > _CACHE_MAX_AGE.total_seconds()
+
+
+def _remove_expired_cache_files():
+    for cache_file in _CACHE_DIR.glob("*.parquet"):
+        try:
+            if _cache_file_expired(cache_file):
+                cache_file.unlink()
+        except OSError:
+            pass
+
+
+def _can_cache(data: pd.DataFrame) -> bool:
+    # Object columns holding dicts, lists, etc. do not round-trip
+    # through parquet unchanged (e.g. dict keys are filled with None).
+    return all(
+        data[col].map(pd.api.types.is_scalar).all()
+        for col in data.select_dtypes(include="object").columns
     )
 
+
+def _normalize_account(account: str) -> str:
+    if account in ("", "-\\-"):
+        return "No Account"
+    return account.rsplit("\\", 1)[-1]
+
+
+def _normalize_accounts(accounts: pd.Series) -> pd.Categorical:
+    # Strip the domain from account names and label empty accounts.
+    # Only the distinct account names are normalized, the results
+    # are mapped back to each row using the factorized codes.
+    acct_codes, unique_accts = pd.factorize(accounts)
+    norm_accts = pd.Categorical([_normalize_account(acct) for acct in unique_accts])
+    # missing accounts have a code of -1 and are filled with NaN
+    return norm_accts.take(acct_codes, allow_fill=True)
+
+
+def _create_event_pivot(
+    activities: pd.Series, accounts: pd.Categorical
+) -> pd.DataFrame:
     # Create a pivot of Event vs. Account
-    win_events_acc = all_events_df[["Account", "Activity", "TimeGenerated"]].copy()
-    win_events_acc = win_events_acc.replace("-\\-", "No Account").replace(
-        {"Account": ""}, value="No Account"
-    )
-    win_events_acc["Account"] = win_events_acc.apply(
-        lambda x: x.Account.split("\\")[-1], axis=1
-    )
-    event_pivot_df = (
-        pd.pivot_table(
-            win_events_acc,
-            values="TimeGenerated",
-            index=["Activity"],
-            columns=["Account"],
-            aggfunc="count",
-        )
-        .fillna(0)
+    return (
+        pd.DataFrame({"Activity": pd.Categorical(activities), "Account": accounts})
+        .groupby(["Activity", "Account"], observed=True)
+        .size()
+        .sort_index()
+        .unstack("Account", fill_value=0)
         .reset_index()
     )
-    return all_events_df, event_pivot_df
 
 
-@set_text(docs=_CELL_DOCS, key="display_event_pivot")
-def _display_event_pivot(event_pivot):
-    display(
-        event_pivot.style.applymap(lambda x: "color: white" if x == 0 else "")
-        .applymap(
-            lambda x: "background-color: lightblue"
-            if not isinstance(x, str) and x > 0
-            else ""
-        )
+# Maximum ratio of unique to total values for a string column to be
+# converted to a categorical
+_CATEGORY_MAX_RATIO = 0.5
+# String columns stored as Arrow strings if not converted to categoricals.
+# Plotted columns (e.g. Account, Activity) are not converted since
+# bokeh cannot serialize the pd.NA missing values of Arrow strings.
+_STRING_COLUMNS = {"EventData"}
+
+
+@lru_cache()
+def _get_arrow_string_dtype() -> Optional[pd.api.extensions.ExtensionDtype]:
+    # Arrow-backed strings need pyarrow and pandas 1.3 or later
+    try:
+        return pd.StringDtype("pyarrow")
+    except (AttributeError, ImportError, TypeError):
+        return None
+
+
+def _optimize_dtypes(data: pd.DataFrame) -> pd.DataFrame:
+    # Reduce memory used by the event data - downcast integer
+    # columns and convert repetitive string columns to categoricals
+    # and EventData to Arrow strings (if available)
+    # The query results are not shared so are modified in place
+    if data.empty:
+        return data
+    string_dtype = _get_arrow_string_dtype()
+    for col in data.select_dtypes(include="integer").columns:
+        downcast = "unsigned" if (data[col] >= 0).all() else "integer"
+        data[col] = pd.to_numeric(data[col], downcast=downcast)
+    for col in data.select_dtypes(include="object").columns:
+        try:
+            unique_ratio = data[col].nunique() / len(data)
+        except TypeError:
+            # unhashable values such as dicts or lists
+            continue
+        if unique_ratio < _CATEGORY_MAX_RATIO:
+            data[col] = data[col].astype("category")
+        elif string_dtype is not None and col in _STRING_COLUMNS:
+            data[col] = data[col].astype(string_dtype)
+    return data
+
+
+def _pivot_count_styles(counts: pd.Series) -> np.ndarray:
+    # Hide zero counts and highlight non-zero counts
+    return np.where(
+        counts == 0,
+        "color: white",
+        np.where(counts > 0, "background-color: lightblue", ""),
+    )
+
+
+def _style_event_pivot(event_pivot: pd.DataFrame):
+    count_cols = event_pivot.columns.drop("Activity")
+    return (
+        event_pivot.style.apply(_pivot_count_styles, subset=count_cols)
         .set_properties(subset=["Activity"], **{"width": "400px", "text-align": "left"})
-        .highlight_max(axis=1)
+        .highlight_max(subset=count_cols, axis=1)
         .hide(axis="index")
     )
 
 
+def _get_event_id_mask(event_data: pd.DataFrame, event_ids: np.ndarray) -> np.ndarray:
+    # Boolean mask of rows matching the event IDs - a single ID
+    # uses a direct comparison rather than a set lookup
+    event_id_values = event_data["EventID"].to_numpy()
+    if event_ids.size == 1:
+        return event_id_values == event_ids[0]
+    return np.isin(event_id_values, event_ids)
+
+
+@set_text(docs=_CELL_DOCS, key="display_event_pivot")
+def _display_event_pivot(event_pivot):
+    display(_style_event_pivot(event_pivot))
+
+
 # %%
 # Extract event details from events
 SCHEMA = "http://schemas.microsoft.com/win/2004/08/events/event"
+# Parser does not resolve entities or fetch external resources
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+_DATA_XPATH = etree.XPath("e:Data", namespaces={"e": SCHEMA})
+# Minimum number of distinct EventData values before parsing is
+# split across processes (if the "parallel_parse" option is set)
+_PARALLEL_PARSE_MIN = 50000
+# ProcessPoolExecutor limit on Windows
+_MAX_WORKERS = 61
+
+
+def _parse_eventdata_xml(event_data: str) -> Optional[Dict[str, Any]]:
+    if not isinstance(event_data, str):
+        return None
+    try:
+        xdoc = etree.fromstring(event_data.encode(), parser=_XML_PARSER)  # nosec
+    except etree.XMLSyntaxError:
+        return None
+    return {elem.attrib["Name"]: elem.text for elem in _DATA_XPATH(xdoc)}
+
+
+def _parse_xml_chunk(xml_values: Iterable[str]) -> List[Optional[Dict[str, Any]]]:
+    return [_parse_eventdata_xml(xml) for xml in xml_values]
 
 
-def _parse_event_data_row(row):
+def _parse_xml_values(xml_values: np.ndarray) -> List[Optional[Dict[str, Any]]]:
+    # Parse EventData values, optionally spreading large data sets
+    # over worker processes. Workers are only used with the "fork"
+    # start method - spawned workers re-import msticnb and msticpy,
+    # which takes longer than parsing the data in this process.
+    workers = min(os.cpu_count() or 1, _MAX_WORKERS)
+    if (
+        not get_opt("parallel_parse")
+        or workers == 1
+        or len(xml_values) < _PARALLEL_PARSE_MIN
+        or _get_start_method() != "fork"
+    ):
+        return _parse_xml_chunk(xml_values)
     try:
-        xdoc = ElementTree.fromstring(row.EventData)
-        col_dict = {
-            elem.attrib["Name"]: elem.text for elem in xdoc.findall(f"{{{SCHEMA}}}Data")
-        }
-        reassigned = set()
-        for key, val in col_dict.items():
-            if key in row and not row[key]:
-                row[key] = val
-                reassigned.add(key)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = executor.map(
+                _parse_xml_chunk, np.array_split(xml_values, workers * 4)
+            )
+            return list(chain.from_iterable(parsed))
+    except (BrokenProcessPool, NotImplementedError, OSError, ValueError):
+        # Process creation may not be available so parse in this process
+        return _parse_xml_chunk(xml_values)
+
+
+def _get_start_method() -> str:
+    # Current multiprocessing start method, without fixing the default
+    return (
+        multiprocessing.get_start_method(allow_none=True)
+        or multiprocessing.get_all_start_methods()[0]
+    )
+
+
+def _reassign_event_columns(
+    src_event_data: pd.DataFrame, event_props: List[Optional[Dict[str, Any]]]
+) -> Dict[str, List[Any]]:
+    # Move values for properties that match an empty column of the
+    # same name from the event properties into the column values.
+    # Returns the updated values for any changed columns.
+    updated_cols = {}
+    prop_names = set().union(*(props for props in event_props if props))
+    for col in prop_names.intersection(src_event_data.columns):
+        col_values = src_event_data[col].to_list()
+        reassigned = False
+        for idx, props in enumerate(event_props):
+            if props and col in props and not col_values[idx]:
+                col_values[idx] = props.pop(col)
+                reassigned = True
         if reassigned:
-            for key in reassigned:
-                col_dict.pop(key)
-        return col_dict
-    except (ParseError, TypeError):
-        return None
+            updated_cols[col] = col_values
+    return updated_cols
 
 
-def _expand_event_properties(input_df):
+def _expand_event_properties(
+    input_df: pd.DataFrame,
+    event_props: List[Optional[Dict[str, Any]]],
+    updated_cols: Dict[str, List[Any]],
+) -> pd.DataFrame:
     # For a specific event ID you can explode the EventProperties values
     # into their own columns using this function. You can do this for
     # the whole data set but it will result
     # in a lot of sparse columns in the output data frame.
-    exp_df = input_df.apply(lambda x: pd.Series(x.EventProperties), axis=1)
-    return (
-        exp_df.drop(set(input_df.columns).intersection(exp_df.columns), axis=1)
-        .merge(
-            input_df.drop("EventProperties", axis=1),
-            how="inner",
-            left_index=True,
-            right_index=True,
-        )
-        .replace("", np.nan)  # these 3 lines get rid of blank columns
-        .dropna(axis=1, how="all")
-        .fillna("")
-    )
+    exp_df = pd.DataFrame([props or {} for props in event_props], index=input_df.index)
+    input_df = input_df.drop(columns="EventProperties", errors="ignore")
+    exp_df = exp_df.drop(set(input_df.columns).intersection(exp_df.columns), axis=1)
+    # merge creates a new frame so the updated and categorical
+    # columns can be replaced without altering the input data
+    merged_df = exp_df.merge(input_df, how="inner", left_index=True, right_index=True)
+    for col, col_values in updated_cols.items():
+        merged_df[col] = col_values
+    # Drop columns with no values, then fill missing values with "".
+    blank_cols = [
+        col
+        for col in merged_df.columns
+        if (merged_df[col].isna() | merged_df[col].eq("")).all()
+    ]
+    merged_df = merged_df.drop(columns=blank_cols)
+    # categoricals need "" as a category before it can be used as a fill value
+    for col in merged_df.select_dtypes(include="category").columns:
+        if "" not in merged_df[col].cat.categories:
+            merged_df[col] = merged_df[col].cat.add_categories("")
+    return merged_df.fillna("")
 
 
 @set_text(docs=_CELL_DOCS, key="parse_eventdata")
 def _parse_eventdata(event_data, event_ids: Optional[Union[int, Iterable[int]]] = None):
+    # The source data is only read here - updated columns are
+    # applied to the expanded output, avoiding a copy of the input
     if event_ids:
-        if isinstance(event_ids, int):
+        if isinstance(event_ids, (int, np.integer, str)):
             event_ids = [event_ids]
-        src_event_data = event_data[event_data["EventID"].isin(event_ids)].copy()
+        event_ids = list(event_ids)
+        if all(isinstance(event_id, (int, np.integer)) for event_id in event_ids):
+            id_mask = _get_event_id_mask(
+                event_data, np.asarray(event_ids, dtype=np.int64)
+            )
+        else:
+            # Non-integer IDs (e.g. strings) are matched as-is, as before
+            id_mask = event_data["EventID"].isin(event_ids).to_numpy()
+        src_event_data = event_data.iloc[id_mask]
     else:
-        src_event_data = event_data.copy()
+        src_event_data = event_data
 
     if src_event_data.empty:
         nb_warn(f"No events matching {event_ids}")
         return None
     # Parse event properties into a dictionary
     nb_markdown("Parsing event data...")
-    src_event_data["EventProperties"] = src_event_data.apply(
-        _parse_event_data_row, axis=1
-    )
-    return _expand_event_properties(src_event_data)
+    # Only parse each distinct EventData value once. Missing values
+    # have a code of -1.
+    xml_codes, unique_xml = pd.factorize(src_event_data["EventData"])
+    parsed_xml = _parse_xml_values(np.asarray(unique_xml, dtype=object))
+    # copy the parsed dicts since these are shared between events
+    event_props = [
+        None if code < 0 or parsed_xml[code] is None else dict(parsed_xml[code])
+        for code in xml_codes
+    ]
+    updated_cols = _reassign_event_columns(src_event_data, event_props)
+    return _expand_event_properties(src_event_data, event_props, updated_cols)
 
 
 # %%
 # Account management events
-def _extract_acct_mgmt_events(event_data):
+@lru_cache()
+def _get_acct_mgmt_event_ids() -> np.ndarray:
     # Get a full list of Windows Security Events
-
     w_evt = pkgutil.get_data("msticpy", f"resources{os.sep}WinSecurityEvent.json")
 
     win_event_df = pd.read_json(w_evt.decode("utf-8"))
@@ -377,47 +696,28 @@ def _extract_acct_mgmt_events(event_data):
     event_list = win_event_df[acct_sel | group_sel | schtask_sel]["event_id"].to_list()
     # Add Service install event
     event_list.append(7045)
-    return event_data[event_data["EventID"].isin(event_list)]
+    event_ids = np.unique(np.asarray(event_list, dtype=np.int32))
+    # the cached array is shared between callers
+    event_ids.flags.writeable = False
+    return event_ids
+
 
+def _get_acct_mgmt_mask(event_data: pd.DataFrame) -> np.ndarray:
+    return _get_event_id_mask(event_data, _get_acct_mgmt_event_ids())
 
-def _create_acct_event_pivot(account_event_data):
+
+def _create_acct_event_pivot(
+    account_event_data: pd.DataFrame, accounts: pd.Categorical
+) -> Optional[pd.DataFrame]:
     # Create a pivot of Event vs. Account
     if account_event_data.empty:
         return None
-    win_events_acc = account_event_data[["Account", "Activity", "TimeGenerated"]].copy()
-    win_events_acc = win_events_acc.replace("-\\-", "No Account").replace(
-        {"Account": ""}, value="No Account"
-    )
-    win_events_acc["Account"] = win_events_acc.apply(
-        lambda x: x.Account.split("\\")[-1], axis=1
-    )
-
-    return (
-        pd.pivot_table(
-            win_events_acc,
-            values="TimeGenerated",
-            index=["Activity"],
-            columns=["Account"],
-            aggfunc="count",
-        )
-        .fillna(0)
-        .reset_index()
-    )
+    return _create_event_pivot(account_event_data["Activity"], accounts)
 
 
 @set_text(docs=_CELL_DOCS, key="display_acct_event_pivot")
 def _display_acct_event_pivot(event_pivot_df):
-    display(
-        event_pivot_df.style.applymap(lambda x: "color: white" if x == 0 else "")
-        .applymap(
-            lambda x: "background-color: lightblue"
-            if not isinstance(x, str) and x > 0
-            else ""
-        )
-        .set_properties(subset=["Activity"], **{"width": "400px", "text-align": "left"})
-        .highlight_max(axis=1)
-        .hide(axis="index")
-    )
+    display(_style_event_pivot(event_pivot_df))
 
 
 @set_text(docs=_CELL_DOCS, key="display_acct_mgmt_timeline")
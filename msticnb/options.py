@@ -13,8 +13,16 @@ Available options are:
 - `debug`: bool (False) - Turn on debug output.
 - `show_sample_results`: bool (True) - Display sample of results as they are produced.
 - `silent`: bool (False) - Execute notebooklets with no output.
+- `cache`: bool (False) - Cache query results locally and re-use them
+  for identical queries. Results are saved as parquet files in the
+  `~/.msticnb_cache` folder and expire after 24 hours. Cached files
+  may contain sensitive data.
+- `parallel_parse`: bool (False) - Parse large sets of Windows event
+  data in multiple processes. Only used on platforms that start
+  processes with "fork" (e.g. Linux).
 
 """
+
 from typing import Any, Dict
 
 from ._version import VERSION
@@ -29,6 +37,14 @@ _OPTION_DEFN = {
     "show_sample_results": (False, "Display sample of results as they are produced."),
     "silent": (False, "Execute notebooklets with no output"),
     "temp_silent": (False, "Execute notebooklets with no output"),
+    "cache": (
+        False,
+        "Cache query results in ~/.msticnb_cache and re-use for identical queries.",
+    ),
+    "parallel_parse": (
+        False,
+        "Parse large sets of Windows event data in multiple processes.",
+    ),
 }
 
 
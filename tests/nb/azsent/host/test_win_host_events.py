@@ -4,31 +4,37 @@
 # license information.
 # --------------------------------------------------------------------------
 """Test the nb_template class."""
+
+import multiprocessing
 import sys
+from datetime import timedelta
 from pathlib import Path
+from unittest.mock import MagicMock
 
+import numpy as np
 import pandas as pd
 import pytest
 import pytest_check as check
 from msticpy.common.timespan import TimeSpan
 
-from msticnb import data_providers, discover_modules, nblts
+from msticnb import data_providers, discover_modules, nblts, options
+from msticnb.nb.azsent.host import win_host_events
 
 from ....unit_test_lib import TEST_DATA_PATH, GeoIPLiteMock, TILookupMock
 
 # pylint: disable=protected-access, no-member, redefined-outer-name, unused-argument
 
-if not sys.platform.startswith("win"):
-    pytest.skip(
-        "skipping Linux and Mac for these tests since Matplotlib fails with no gui",
-        allow_module_level=True,
-    )
+win_only = pytest.mark.skipif(
+    not sys.platform.startswith("win"),
+    reason="skipping Linux and Mac for these tests since Matplotlib fails with no gui",
+)
 
 
 @pytest.fixture
-def init_notebooklets(monkeypatch):
+def init_notebooklets(monkeypatch, tmp_path):
     """Initialize notebooklets."""
     test_data = str(Path(TEST_DATA_PATH).absolute())
+    monkeypatch.setattr(win_host_events, "_CACHE_DIR", tmp_path)
 
     discover_modules()
     monkeypatch.setattr(data_providers, "GeoLiteLookup", GeoIPLiteMock)
@@ -41,6 +47,7 @@ def init_notebooklets(monkeypatch):
     )
 
 
+@win_only
 def test_winhostevents_notebooklet(init_notebooklets):
     """Test basic run of notebooklet."""
     test_nb = nblts.azsent.host.WinHostEvents()
@@ -65,3 +72,436 @@ def test_winhostevents_notebooklet(init_notebooklets):
 
     exp_events = test_nb.expand_events(99999)
     check.is_none(exp_events)
+
+
+@win_only
+def test_winhostevents_query_cache(init_notebooklets, tmp_path):
+    """Test results that do not survive parquet are not cached."""
+    pytest.importorskip("pyarrow")
+    test_nb = nblts.azsent.host.WinHostEvents()
+    tspan = TimeSpan(start="2022-09-01", end="2022-09-02")
+
+    # the test data has an EventProperties column of dicts
+    test_nb.run(value="myhost", timespan=tspan, cache=True)
+    check.equal(len(list(tmp_path.glob("*.parquet"))), 0)
+
+
+def _query_results():
+    return pd.DataFrame(
+        {
+            "TimeGenerated": pd.to_datetime(["2022-09-01 01:00", "2022-09-01 02:00"]),
+            "Account": ["DOM\\user1", "-\\-"],
+            "EventID": [4720, 4732],
+        }
+    )
+
+
+def test_cached_query(monkeypatch, tmp_path):
+    """Test query results are cached and re-used."""
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(win_host_events, "_CACHE_DIR", tmp_path)
+    query_calls = []
+
+    def query_func():
+        query_calls.append(1)
+        return _query_results()
+
+    cache_key = ("test_query", "workspace1", "myhost")
+    result = win_host_events._cached_query(cache_key, query_func, use_cache=True)
+    check.equal(len(list(tmp_path.glob("*.parquet"))), 1)
+
+    cached = win_host_events._cached_query(cache_key, query_func, use_cache=True)
+    check.equal(len(query_calls), 1)
+    pd.testing.assert_frame_equal(cached, result)
+
+    # a different workspace must not re-use the cached results
+    win_host_events._cached_query(
+        ("test_query", "workspace2", "myhost"), query_func, use_cache=True
+    )
+    check.equal(len(query_calls), 2)
+    check.equal(len(list(tmp_path.glob("*.parquet"))), 2)
+
+    # caching disabled
+    win_host_events._cached_query(cache_key, query_func, use_cache=False)
+    check.equal(len(query_calls), 3)
+
+
+def test_cached_query_expiry(monkeypatch, tmp_path):
+    """Test expired cache files are not used and are removed."""
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(win_host_events, "_CACHE_DIR", tmp_path)
+    query_calls = []
+
+    def query_func():
+        query_calls.append(1)
+        return _query_results()
+
+    win_host_events._cached_query(("test_query",), query_func, use_cache=True)
+    monkeypatch.setattr(win_host_events, "_CACHE_MAX_AGE", timedelta(seconds=-1))
+    win_host_events._cached_query(("test_query",), query_func, use_cache=True)
+    check.equal(len(query_calls), 2)
+
+    win_host_events._cached_query(("other_query",), query_func, use_cache=True)
+    check.equal(len(list(tmp_path.glob("*.parquet"))), 1)
+
+
+def test_cached_query_unsupported_data(monkeypatch, tmp_path):
+    """Test data that does not round-trip through parquet is not cached."""
+    monkeypatch.setattr(win_host_events, "_CACHE_DIR", tmp_path)
+    data = _query_results()
+    data["EventProperties"] = [{"TargetUserName": "user1"}, {"MemberName": "user2"}]
+
+    result = win_host_events._cached_query(("test_query",), lambda: data, True)
+    check.is_true(result is data)
+    check.equal(len(list(tmp_path.glob("*.parquet"))), 0)
+
+
+def test_cache_option_default():
+    """Test query caching is off by default."""
+    check.is_false(options._OPTION_DEFN["cache"][0])
+
+
+@pytest.mark.parametrize("dtype", [object, "category", "string"])
+def test_normalize_accounts(dtype):
+    """Test account names are normalized."""
+    accounts = pd.Series(
+        ["DOM\\user1", "", "-\\-", "user2", "A\\B\\user3", None, "DOM\\user1"],
+        dtype=dtype,
+    )
+    norm_accounts = win_host_events._normalize_accounts(accounts)
+
+    check.is_instance(norm_accounts, pd.Categorical)
+    check.equal(
+        list(norm_accounts[:5]),
+        ["user1", "No Account", "No Account", "user2", "user3"],
+    )
+    check.is_true(pd.isna(norm_accounts[5]))
+    check.equal(norm_accounts[6], "user1")
+
+
+def test_create_event_pivot():
+    """Test event pivot matches the previous pivot_table output."""
+    events = pd.DataFrame(
+        {
+            "TimeGenerated": pd.date_range("2022-09-01", periods=6, freq="H"),
+            "Activity": [
+                "4720 - a",
+                "4732 - b",
+                "4720 - a",
+                "5061 - c",
+                "4732 - b",
+                "4720 - a",
+            ],
+            "Account": ["user1", "user2", "user1", "user3", "user1", "user2"],
+        }
+    )
+    expected = (
+        pd.pivot_table(
+            events,
+            values="TimeGenerated",
+            index=["Activity"],
+            columns=["Account"],
+            aggfunc="count",
+        )
+        .fillna(0)
+        .reset_index()
+    )
+
+    event_pivot = win_host_events._create_event_pivot(
+        events["Activity"], pd.Categorical(events["Account"])
+    )
+    event_pivot.columns = list(event_pivot.columns)
+    expected.columns = list(expected.columns)
+    pd.testing.assert_frame_equal(
+        event_pivot.astype({"Activity": str}), expected, check_dtype=False
+    )
+
+
+def _event_xml(**props):
+    data_elems = "".join(
+        f'<Data Name="{name}">{value}</Data>' for name, value in props.items()
+    )
+    return f'<EventData xmlns="{win_host_events.SCHEMA}">{data_elems}</EventData>'
+
+
+def _security_events():
+    return pd.DataFrame(
+        {
+            "EventID": pd.Series([4720, 4732, 5061, 4720], dtype="uint16"),
+            "TargetUserName": ["", "user2", "", "user4"],
+            "EventData": [
+                _event_xml(TargetUserName="user1", SamAccountName="user1"),
+                _event_xml(TargetUserName="other", MemberName="user2"),
+                _event_xml(KeyName="key1"),
+                _event_xml(TargetUserName="user4", SamAccountName="user4"),
+            ],
+        }
+    )
+
+
+def test_get_event_id_mask():
+    """Test EventID mask for one or more event IDs."""
+    events = _security_events()
+    mask = win_host_events._get_event_id_mask(events, np.array([4720]))
+    check.equal(mask.tolist(), [True, False, False, True])
+    mask = win_host_events._get_event_id_mask(events, np.array([4732, 5061, 1]))
+    check.equal(mask.tolist(), [False, True, True, False])
+
+
+@pytest.mark.parametrize(
+    "event_ids, exp_rows",
+    [
+        (4720, 2),
+        ([4732, 5061], 2),
+        (np.int64(5061), 1),
+        ("4720", None),
+        (["4720"], None),
+    ],
+)
+def test_parse_eventdata_event_ids(event_ids, exp_rows):
+    """Test expanded events are filtered by event ID."""
+    events = _security_events()
+    if exp_rows is None:
+        # non-integer IDs do not match but must not raise
+        check.is_none(win_host_events._parse_eventdata(events, event_ids))
+        return
+    expanded = win_host_events._parse_eventdata(events, event_ids)
+    check.equal(len(expanded), exp_rows)
+
+
+def test_parse_eventdata_xml():
+    """Test parsing EventData XML."""
+    check.equal(
+        win_host_events._parse_eventdata_xml(
+            _event_xml(TargetUserName="user1", MemberName="user2")
+        ),
+        {"TargetUserName": "user1", "MemberName": "user2"},
+    )
+    check.equal(
+        win_host_events._parse_eventdata_xml(
+            f'<EventData xmlns="{win_host_events.SCHEMA}"><Data Name="Empty"/>'
+            "</EventData>"
+        ),
+        {"Empty": None},
+    )
+    check.is_none(win_host_events._parse_eventdata_xml("<EventData><Data"))
+    check.is_none(win_host_events._parse_eventdata_xml(None))
+    check.is_none(win_host_events._parse_eventdata_xml(float("nan")))
+    # entities are not expanded
+    entity_xml = (
+        '<!DOCTYPE EventData [<!ENTITY ent "expanded">]>'
+        f'<EventData xmlns="{win_host_events.SCHEMA}"><Data Name="Ent">&ent;</Data>'
+        "</EventData>"
+    )
+    check.not_equal(
+        win_host_events._parse_eventdata_xml(entity_xml), {"Ent": "expanded"}
+    )
+
+
+def test_reassign_event_columns():
+    """Test event properties are moved into matching empty columns."""
+    events = _security_events()
+    event_props = [
+        win_host_events._parse_eventdata_xml(xml) for xml in events["EventData"]
+    ]
+    event_props.append(None)
+    events.loc[len(events)] = [4720, "", None]
+
+    updated_cols = win_host_events._reassign_event_columns(events, event_props)
+    check.equal(list(updated_cols), ["TargetUserName"])
+    check.equal(updated_cols["TargetUserName"], ["user1", "user2", "", "user4", ""])
+    # reassigned values are removed from the properties
+    check.equal(event_props[0], {"SamAccountName": "user1"})
+    check.equal(event_props[1], {"TargetUserName": "other", "MemberName": "user2"})
+    check.equal(event_props[3], {"TargetUserName": "user4", "SamAccountName": "user4"})
+    # the source data is not changed
+    check.equal(events["TargetUserName"].to_list(), ["", "user2", "", "user4", ""])
+
+
+def test_parse_eventdata():
+    """Test expanding EventData into columns."""
+    events = _security_events()
+    expanded = win_host_events._parse_eventdata(events)
+
+    check.equal(len(expanded), len(events))
+    check.equal(expanded["TargetUserName"].to_list(), ["user1", "user2", "", "user4"])
+    check.equal(expanded["SamAccountName"].to_list(), ["user1", "", "", "user4"])
+    check.equal(expanded["KeyName"].to_list(), ["", "", "key1", ""])
+    check.is_not_in("EventProperties", expanded.columns)
+    check.equal(events["TargetUserName"].to_list(), ["", "user2", "", "user4"])
+
+
+def test_optimize_dtypes():
+    """Test event data columns are downcast in place."""
+    events = pd.DataFrame(
+        {
+            "EventID": [4720, 4732, 4720, 4720, 4720],
+            "Offset": [-1, 2, 3, 4, 5],
+            "Activity": ["4720 - a", "4732 - b", "4720 - a", "4720 - a", "4720 - a"],
+            "EventData": ["<a/>", "<b/>", "<c/>", "<d/>", "<e/>"],
+            "Account": ["u1", "u2", "u3", "u4", None],
+            "Other": ["v", "w", "x", "y", "z"],
+            "EventProperties": [{"a": 1}, {}, {}, {}, {}],
+        }
+    )
+    result = win_host_events._optimize_dtypes(events)
+
+    check.is_true(result is events)
+    check.equal(result["EventID"].dtype, np.uint16)
+    check.equal(result["Offset"].dtype, np.int8)
+    check.equal(result["Activity"].dtype, "category")
+    if win_host_events._get_arrow_string_dtype() is not None:
+        check.equal(result["EventData"].dtype, pd.StringDtype("pyarrow"))
+    else:
+        check.equal(result["EventData"].dtype, object)
+    # plotted columns are not converted to Arrow strings
+    check.equal(result["Account"].dtype, object)
+    check.is_none(result["Account"].iloc[4])
+    check.equal(result["Other"].dtype, object)
+    check.equal(result["EventProperties"].dtype, object)
+    check.equal(result["Activity"].to_list()[1], "4732 - b")
+
+
+def test_parse_xml_values_parallel(monkeypatch):
+    """Test EventData parsed across processes matches serial parsing."""
+    xml_values = np.array(
+        [_event_xml(TargetUserName=f"user{idx}") for idx in range(20)] + ["<bad"],
+        dtype=object,
+    )
+    expected = win_host_events._parse_xml_values(xml_values)
+    check.equal(expected[3], {"TargetUserName": "user3"})
+    check.is_none(expected[-1])
+
+    monkeypatch.setattr(win_host_events, "_PARALLEL_PARSE_MIN", 2)
+    monkeypatch.setattr(win_host_events.os, "cpu_count", lambda: 2)
+    monkeypatch.setitem(options._OPT_DICT, "parallel_parse", True)
+    if "fork" in multiprocessing.get_all_start_methods():
+        monkeypatch.setattr(win_host_events, "_get_start_method", lambda: "fork")
+        check.equal(win_host_events._parse_xml_values(xml_values), expected)
+
+
+class _FailingExecutor:
+    """ProcessPoolExecutor that raises on creation."""
+
+    max_workers = None
+
+    def __init__(self, max_workers=None):
+        _FailingExecutor.max_workers = max_workers
+        raise ValueError("max_workers must be <= 61")
+
+
+@pytest.mark.parametrize(
+    "parallel_parse, start_method", [(False, "fork"), (True, "spawn"), (True, "fork")]
+)
+def test_parse_xml_values_serial(monkeypatch, parallel_parse, start_method):
+    """Test EventData is parsed in process if workers are not used or fail."""
+    xml_values = np.array(
+        [_event_xml(TargetUserName=f"user{idx}") for idx in range(20)], dtype=object
+    )
+    monkeypatch.setattr(win_host_events, "_PARALLEL_PARSE_MIN", 2)
+    monkeypatch.setattr(win_host_events.os, "cpu_count", lambda: 128)
+    monkeypatch.setitem(options._OPT_DICT, "parallel_parse", parallel_parse)
+    monkeypatch.setattr(win_host_events, "_get_start_method", lambda: start_method)
+    monkeypatch.setattr(win_host_events, "ProcessPoolExecutor", _FailingExecutor)
+    monkeypatch.setattr(_FailingExecutor, "max_workers", None)
+
+    parsed = win_host_events._parse_xml_values(xml_values)
+    check.equal(len(parsed), 20)
+    check.equal(parsed[3], {"TargetUserName": "user3"})
+    if parallel_parse and start_method == "fork":
+        check.equal(_FailingExecutor.max_workers, 61)
+
+
+def _mock_query_provider(events=None):
+    qry_prov = MagicMock()
+    qry_prov.environment = "MSSentinel"
+    qry_prov.connection_string = "workspace1"
+    qry_prov.WindowsSecurity.list_host_events.return_value = (
+        _security_events() if events is None else events
+    )
+    return qry_prov
+
+
+_BASE_COLUMNS = (
+    "TimeGenerated, Account, Activity, EventID, EventData, Computer, "
+    "SubjectUserName, SubjectDomainName, SubjectUserSid, SubjectLogonId, "
+    "SubjectAccount, TargetUserName, TargetDomainName, TargetUserSid, "
+    "TargetAccount, MemberName, MemberSid, SamAccountName"
+)
+
+
+@pytest.mark.parametrize(
+    "kwargs, exp_project",
+    [
+        ({}, f" | project {_BASE_COLUMNS}"),
+        (
+            {"add_columns": ["Channel", "EventID", "Channel", "Level"]},
+            f" | project {_BASE_COLUMNS}, Channel, Level",
+        ),
+        ({"all_columns": True}, ""),
+        ({"add_columns": ["Channel"], "all_columns": True}, ""),
+    ],
+)
+def test_get_win_security_events_query(kwargs, exp_project):
+    """Test the columns projected by the security events query."""
+    qry_prov = _mock_query_provider()
+    tspan = TimeSpan(start="2022-09-01", end="2022-09-02")
+
+    events = win_host_events._get_win_security_events(
+        qry_prov, host_name="myhost", timespan=tspan, **kwargs
+    )
+    check.equal(len(events), 4)
+    qry_prov.WindowsSecurity.list_host_events.assert_called_once()
+    call_args, call_kwargs = qry_prov.WindowsSecurity.list_host_events.call_args
+    check.equal(call_args, (tspan,))
+    check.equal(call_kwargs["host_name"], "myhost")
+    check.equal(
+        call_kwargs["add_query_items"],
+        "| where EventID != 4688 and EventID != 4624" + exp_project,
+    )
+
+
+def test_style_event_pivot():
+    """Test event pivot styles only apply to the count columns."""
+    event_pivot = pd.DataFrame(
+        {"Activity": ["4720 - a", "4732 - b"], "user1": [2, 1], "user2": [0, 3]}
+    )
+    styler = win_host_events._style_event_pivot(event_pivot)
+    html = styler.to_html()
+    check.is_in("4732 - b", html)
+
+    styles = {pos: dict(props) for pos, props in styler._compute().ctx.items()}
+    check.equal(styles[(0, 0)], {"width": "400px", "text-align": "left"})
+    check.equal(styles[(0, 1)]["background-color"], "yellow")
+    check.equal(styles[(0, 2)], {"color": "white"})
+    check.equal(styles[(1, 1)], {"background-color": "lightblue"})
+    check.equal(styles[(1, 2)]["background-color"], "yellow")
+
+
+def test_winhostevents_event_pivot_option(init_notebooklets):
+    """Test the event pivot is only created if the option is selected."""
+    events = _security_events()
+    events["TimeGenerated"] = pd.date_range("2022-09-01", periods=4, freq="H")
+    events["Account"] = ["DOM\\user1", "DOM\\admin", "", "DOM\\admin"]
+    events["Activity"] = ["4720 - a", "4732 - b", "5061 - c", "4720 - a"]
+    test_nb = nblts.azsent.host.WinHostEvents()
+    test_nb.query_provider = _mock_query_provider()
+    test_nb.query_provider.WindowsSecurity.list_host_events.side_effect = (
+        lambda *args, **kwargs: events.copy()
+    )
+    tspan = TimeSpan(start="2022-09-01", end="2022-09-02")
+
+    result = test_nb.run(value="myhost", timespan=tspan, options=["expand_events"])
+    check.is_none(result.event_pivot)
+    check.is_none(result.account_events)
+    check.is_instance(result.all_events, pd.DataFrame)
+    check.is_instance(result.expanded_events, pd.DataFrame)
+
+    result = test_nb.run(value="myhost", timespan=tspan, options=["event_pivot"])
+    check.is_instance(result.event_pivot, pd.DataFrame)
+    check.equal(
+        list(result.event_pivot.columns), ["Activity", "No Account", "admin", "user1"]
+    )
+    check.is_none(result.account_events)
+    check.is_none(result.expanded_events)
+    check.equal(test_nb.query_provider.WindowsSecurity.list_host_events.call_count, 2)